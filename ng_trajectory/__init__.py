@@ -43,6 +43,7 @@ from .version import __version__
 ROS_AVAILABLE = None
 PLOT_AVAILABLE = None
 SHAPELY_AVAILABLE = None
+NUMBA_AVAILABLE = None
 
 
 try:
@@ -102,6 +103,16 @@ except:
     SHAPELY_AVAILABLE = False
 
 
+try:
+    import numba
+
+    NUMBA_AVAILABLE = True
+
+except:
+    print ("Numba is not available.")
+    NUMBA_AVAILABLE = False
+
+
 ######################
 # ROS dependencies
 ######################
@@ -18,6 +18,7 @@ import sys, os
 
 # Parallel computing of genetic algorithm
 from concurrent import futures
+import multiprocessing
 
 # Thread lock for log file
 from threading import Lock
@@ -29,6 +30,7 @@ from typing import Tuple, Callable, Dict, TextIO, List, types
 # Global variables
 OPTIMIZER = None
 MATRYOSHKA = None
+MATRYOSHKA_SOA = None
 VALID_POINTS = None
 CRITERION = None
 CRITERION_ARGS = None
@@ -41,6 +43,9 @@ SELECTOR_ARGS = None
 PENALIZER = None
 PENALIZER_INIT = None
 PENALIZER_ARGS = None
+INTERPOLATOR_KWARGS = None
+PENALIZER_KWARGS = None
+CRITERION_KWARGS = None
 LOGFILE = None
 VERBOSITY = 3
 FILELOCK = Lock()
@@ -49,6 +54,12 @@ GRID = None
 PENALTY = None
 FIGURE = None
 PLOT = None
+BATCH_SIZE = 1
+
+# Workers use the state of this module inherited from the parent process,
+# therefore they have to be forked (not spawned).
+EXECUTOR_ARGS = { "mp_context": multiprocessing.get_context("fork") } \
+    if sys.version_info >= (3, 7) and "fork" in multiprocessing.get_all_start_methods() else {}
 
 
 # Parameters
@@ -71,6 +82,7 @@ P.createAdd("penalizer_init", {}, dict, "Arguments for the init part of the pena
 P.createAdd("penalizer_args", {}, dict, "Arguments for the penalizer function.", "init (general)")
 P.createAdd("logging_verbosity", 2, int, "Index for verbosity of the logger.", "init (general)")
 P.createAdd("hold_matryoshka", False, bool, "Whether the transformation should be created only once.", "init (Matryoshka)")
+P.createAdd("batch_size", 1, int, "Number of candidates evaluated by a worker at once.", "init (Matryoshka)")
 P.createAdd("plot", False, bool, "Whether a graphical representation should be created.", "init (viz.)")
 P.createAdd("grid", "computed by default", list, "X-size and y-size of the grid used for points discretization.", "init (Matryoshka)")
 P.createAdd("plot_mapping", False, bool, "Whether a grid should be mapped onto the track (to show the mapping).", "init (viz.)")
@@ -100,6 +112,7 @@ def init(points: numpy.ndarray, group_centers: numpy.ndarray, group_centerline:
         logfile: TextIO = sys.stdout,
         logging_verbosity: int = 2,
         hold_matryoshka: bool = False,
+        batch_size: int = 1,
         plot: bool = False,
         grid: List[float] = [],
         figure: ngplot.matplotlib.figure.Figure = None,
@@ -139,13 +152,15 @@ def init(points: numpy.ndarray, group_centers: numpy.ndarray, group_centerline:
     logfile -- file descriptor for logging, TextIO, default sys.stdout
     logging_verbosity -- index for verbosity of logger, int, default 2
     hold_matryoshka -- whether the Matryoshka should be created only once, bool, default False
+    batch_size -- number of candidates evaluated by a worker at once, int, default 1
     plot -- whether a graphical representation should be created, bool, default False
     grid -- size of the grid used for the points discretization, 2-float List, computed by default
     figure -- target figure for plotting, matplotlib.figure.Figure, default None (get current)
     **kwargs -- arguments not caught by previous parts
     """
-    global OPTIMIZER, MATRYOSHKA, VALID_POINTS, LOGFILE, VERBOSITY, HOLDMAP, GRID, PENALTY, FIGURE, PLOT
+    global OPTIMIZER, MATRYOSHKA, MATRYOSHKA_SOA, VALID_POINTS, LOGFILE, VERBOSITY, HOLDMAP, GRID, PENALTY, FIGURE, PLOT, BATCH_SIZE
     global CRITERION, CRITERION_ARGS, INTERPOLATOR, INTERPOLATOR_ARGS, SEGMENTATOR, SEGMENTATOR_ARGS, SELECTOR, SELECTOR_ARGS, PENALIZER, PENALIZER_INIT, PENALIZER_ARGS
+    global INTERPOLATOR_KWARGS, PENALIZER_KWARGS, CRITERION_KWARGS
 
     # Local to global variables
     CRITERION = criterion
@@ -165,6 +180,7 @@ def init(points: numpy.ndarray, group_centers: numpy.ndarray, group_centerline:
     PENALTY = penalty
     FIGURE = figure
     PLOT = plot
+    BATCH_SIZE = max(1, batch_size)
 
 
     VALID_POINTS = points
@@ -213,12 +229,16 @@ def init(points: numpy.ndarray, group_centers: numpy.ndarray, group_centerline:
 
         MATRYOSHKA = [ transform.matryoshkaCreate(grouplayers[_i], layers_center[_i], layers_count[_i]) for _i in range(len(_groups)) ]
 
+        # Pack the mappings into arrays for evaluating all groups at once
+        MATRYOSHKA_SOA = transform.matryoshkaPack(MATRYOSHKA)
+
         if plot and P.getValue("plot_mapping"):
             xx, yy = numpy.meshgrid(numpy.linspace(0, 1, 110), numpy.linspace(0, 1, 110))
             gridpoints = numpy.hstack((xx.flatten()[:, numpy.newaxis], yy.flatten()[:, numpy.newaxis]))
 
-            for _g in range(len(_groups)):
-                ngplot.pointsScatter(transform.matryoshkaMap(MATRYOSHKA[_g], gridpoints), marker="x", s=0.1)
+            # Each group is plotted separately to obtain its own color
+            for _mapping in transform.matryoshkaMapBatchAll(MATRYOSHKA_SOA, gridpoints):
+                ngplot.pointsScatter(_mapping, marker="x", s=0.1)
 
         print ("Matryoshka mapping constructed.")
 
@@ -230,9 +250,22 @@ def init(points: numpy.ndarray, group_centers: numpy.ndarray, group_centerline:
                 GRID = [ _GRID, _GRID ]
 
 
+    # Arguments of the parts used by '_opt'
+    # Only the candidate-specific values ('points', 'candidate') are changed in every call.
+    # 'optimization' is reset by 'optimize()' for the final evaluation only.
+    INTERPOLATOR_KWARGS = {**{"points": None}, **INTERPOLATOR_ARGS}
+    PENALIZER_KWARGS = {
+        **{"points": None, "valid_points": VALID_POINTS, "grid": GRID, "penalty": PENALTY, "candidate": None},
+        **PENALIZER_ARGS,
+        **{"optimization": True}
+    }
+    CRITERION_KWARGS = {**{"points": None}, **CRITERION_ARGS}
+
+
     # Optimizer definition
     instrum = nevergrad.Instrumentation(nevergrad.var.Array(len(MATRYOSHKA), 2).bounded(0, 1))
-    OPTIMIZER = nevergrad.optimizers.DoubleFastGADiscreteOnePlusOne(instrumentation = instrum, budget = budget, num_workers = workers)
+    # When evaluating in batches, each worker receives 'BATCH_SIZE' candidates at once.
+    OPTIMIZER = nevergrad.optimizers.DoubleFastGADiscreteOnePlusOne(instrumentation = instrum, budget = budget, num_workers = workers * BATCH_SIZE)
 
 
 def optimize() -> Tuple[float, numpy.ndarray, numpy.ndarray, numpy.ndarray]:
@@ -244,22 +277,29 @@ def optimize() -> Tuple[float, numpy.ndarray, numpy.ndarray, numpy.ndarray]:
     tcpoints -- points in the best solution in transformed coordinates, nx2 numpy.ndarray
     trajectory -- trajectory of the best solution in real coordinates, mx2 numpy.ndarray
     """
-    global OPTIMIZER, MATRYOSHKA, LOGFILE, FILELOCK, VERBOSITY, INTERPOLATOR, INTERPOLATOR_ARGS, FIGURE, PLOT, PENALIZER, PENALIZER_ARGS
+    global OPTIMIZER, MATRYOSHKA, MATRYOSHKA_SOA, LOGFILE, FILELOCK, VERBOSITY, INTERPOLATOR, INTERPOLATOR_ARGS, FIGURE, PLOT, PENALIZER, PENALIZER_ARGS, BATCH_SIZE
+    global INTERPOLATOR_KWARGS, PENALIZER_KWARGS
 
-    with futures.ProcessPoolExecutor(max_workers=OPTIMIZER.num_workers) as executor:
-        recommendation = OPTIMIZER.minimize(_opt, executor=executor, batch_mode=False)
+    # Optimizer counts every candidate of a batch as a worker
+    with futures.ProcessPoolExecutor(max_workers=OPTIMIZER.num_workers // BATCH_SIZE, **EXECUTOR_ARGS) as executor:
+        if BATCH_SIZE > 1:
+            recommendation = _minimizeBatch(executor)
+        else:
+            recommendation = OPTIMIZER.minimize(_opt, executor=executor, batch_mode=False)
 
-    points = [ transform.matryoshkaMap(MATRYOSHKA[i], [p])[0] for i, p in enumerate(numpy.asarray(recommendation.args[0])) ]
+    tcpoints = numpy.asarray(recommendation.args[0])
+    points = transform.matryoshkaMapBatch(MATRYOSHKA_SOA, tcpoints)
 
-    PENALIZER_ARGS["optimization"] = False
-    final = _opt(numpy.asarray(recommendation.args[0]))
+    PENALIZER_KWARGS["optimization"] = False
+    final = _opt(tcpoints)
 
 
     ## Plot invalid points if available
 
     # Interpolate received points
     # It is expected that they are unique and sorted.
-    _points = INTERPOLATOR.interpolate(**{**{"points": numpy.asarray(points)}, **INTERPOLATOR_ARGS})
+    INTERPOLATOR_KWARGS["points"] = points
+    _points = INTERPOLATOR.interpolate(**INTERPOLATOR_KWARGS)
 
     # Display invalid points if found
     if PLOT and len(PENALIZER.INVALID_POINTS) > 0:
@@ -270,10 +310,59 @@ def optimize() -> Tuple[float, numpy.ndarray, numpy.ndarray, numpy.ndarray]:
 
     with FILELOCK:
         if VERBOSITY > 0:
-            print ("solution:%s" % str(numpy.asarray(points).tolist()), file=LOGFILE)
+            print ("solution:%s" % str(points.tolist()), file=LOGFILE)
             print ("final:%f" % final, file=LOGFILE)
 
-    return final, numpy.asarray(points), numpy.asarray(recommendation.args[0]), INTERPOLATOR.interpolate(**{**{"points": numpy.asarray(points)}, **INTERPOLATOR_ARGS})
+    return final, points, tcpoints, _points
+
+
+def _minimizeBatch(executor: futures.Executor) -> any:
+    """Run genetic algorithm via Nevergrad evaluating the candidates in batches.
+
+    Arguments:
+    executor -- pool of workers to evaluate the candidates, concurrent.futures.Executor
+
+    Returns:
+    recommendation -- best candidate found by the optimizer, nevergrad Candidate
+
+    Note: In contrast to 'minimize' with 'batch_mode', the candidates are not
+    submitted one by one, but 'BATCH_SIZE' candidates to each worker.
+    """
+    global OPTIMIZER, BATCH_SIZE
+
+    _remaining = OPTIMIZER.budget - OPTIMIZER.num_ask
+
+    while _remaining > 0:
+        _candidates = [ OPTIMIZER.ask() for _i in range(min(_remaining, OPTIMIZER.num_workers)) ]
+        _remaining -= len(_candidates)
+
+        _batches = [ _candidates[_i:_i + BATCH_SIZE] for _i in range(0, len(_candidates), BATCH_SIZE) ]
+
+        _jobs = [
+            executor.submit(_optBatch, numpy.asarray([ _candidate.args[0] for _candidate in _batch ]))
+            for _batch in _batches
+        ]
+
+        for _batch, _job in zip(_batches, _jobs):
+            for _candidate, _value in zip(_batch, _job.result()):
+                OPTIMIZER.tell(_candidate, _value)
+
+    return OPTIMIZER.provide_recommendation()
+
+
+def _optBatch(points: numpy.ndarray) -> List[float]:
+    """Evaluate a batch of candidates.
+
+    Arguments:
+    points -- selected points of the candidates, bxnx2 numpy.ndarray
+
+    Returns:
+    _cs -- criterion values (or penalties) of the candidates, b-list of floats
+
+    Note: Interpolators, penalizers and criterions work on a single candidate,
+    so the candidates are evaluated one by one by '_opt'.
+    """
+    return [ _opt(_points) for _points in points ]
 
 
 def _opt(points: numpy.ndarray) -> float:
@@ -295,35 +384,43 @@ def _opt(points: numpy.ndarray) -> float:
     Note: This function is called after all necessary data is received.
     """
     global VALID_POINTS, CRITERION, CRITERION_ARGS, INTERPOLATOR, INTERPOLATOR_ARGS, PENALIZER, PENALIZER_ARGS
-    global MATRYOSHKA, LOGFILE, FILELOCK, VERBOSITY, GRID, PENALTY
+    global INTERPOLATOR_KWARGS, PENALIZER_KWARGS, CRITERION_KWARGS
+    global MATRYOSHKA, MATRYOSHKA_SOA, LOGFILE, FILELOCK, VERBOSITY, GRID, PENALTY
 
     # Transform points
-    points = [ transform.matryoshkaMap(MATRYOSHKA[i], [p])[0] for i, p in enumerate(points) ]
+    points = transform.matryoshkaMapBatch(MATRYOSHKA_SOA, points)
 
     # Interpolate received points
     # It is expected that they are unique and sorted.
-    _points = INTERPOLATOR.interpolate(**{**{"points": numpy.asarray(points)}, **INTERPOLATOR_ARGS})
+    INTERPOLATOR_KWARGS["points"] = numpy.asarray(points)
+    _points = INTERPOLATOR.interpolate(**INTERPOLATOR_KWARGS)
 
     # Check the correctness of the points and compute penalty
-    penalty = PENALIZER.penalize(**{**{"points": _points, "valid_points": VALID_POINTS, "grid": GRID, "penalty": PENALTY, "candidate": points}, **PENALIZER_ARGS})
+    PENALIZER_KWARGS["points"] = _points
+    PENALIZER_KWARGS["candidate"] = points
+
+    penalty = PENALIZER.penalize(**PENALIZER_KWARGS)
 
     if ( penalty != 0 ):
-        with FILELOCK:
-            if VERBOSITY > 2:
-                print ("pointsA:%s" % str(points), file=LOGFILE)
-                print ("pointsT:%s" % str(_points.tolist()), file=LOGFILE)
-            if VERBOSITY > 1:
+        # Nothing is logged otherwise, so the lock and the flush are skipped
+        if VERBOSITY > 1:
+            with FILELOCK:
+                if VERBOSITY > 2:
+                    print ("pointsA:%s" % str(points.tolist()), file=LOGFILE)
+                    print ("pointsT:%s" % str(_points.tolist()), file=LOGFILE)
                 print ("penalty:%f" % penalty, file=LOGFILE)
-            LOGFILE.flush()
+                LOGFILE.flush()
         return penalty
 
-    _c = CRITERION.compute(**{**{'points': _points}, **CRITERION_ARGS})
-    with FILELOCK:
-        if VERBOSITY > 2:
-            print ("pointsA:%s" % str(points), file=LOGFILE)
-            print ("pointsT:%s" % str(_points.tolist()), file=LOGFILE)
-        if VERBOSITY > 1:
+    CRITERION_KWARGS["points"] = _points
+    _c = CRITERION.compute(**CRITERION_KWARGS)
+
+    if VERBOSITY > 1:
+        with FILELOCK:
+            if VERBOSITY > 2:
+                print ("pointsA:%s" % str(points.tolist()), file=LOGFILE)
+                print ("pointsT:%s" % str(_points.tolist()), file=LOGFILE)
             print ("correct:%f" % _c, file=LOGFILE)
-        LOGFILE.flush()
+            LOGFILE.flush()
 
     return _c
@@ -12,12 +12,17 @@ import numpy
 from scipy.interpolate import bisplrep, bisplev
 
 # Typing support for other types
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 
 # Utils functions
 from ng_trajectory.interpolators.utils import trajectoryReduce, trajectorySort
 from .interpolate import trajectoryInterpolate
 
+from ng_trajectory import NUMBA_AVAILABLE
+
+if NUMBA_AVAILABLE:
+    from numba import njit
+
 
 # Typing
 Interpolator = List[numpy.ndarray]
@@ -466,3 +471,247 @@ def matryoshkaMap(matryoshka: List[Interpolator], coords: numpy.ndarray) -> nump
         _rcoords.append(_dims)
 
     return numpy.asarray(_rcoords)
+
+
+def matryoshkaPack(matryoshkas: List[List[Interpolator]]) -> Dict[str, numpy.ndarray]:
+    """Pack Matryoshka mappings of the groups into arrays.
+
+    Arguments:
+    matryoshkas -- mappings of the groups, n-list of p-lists of bisplrep
+
+    Returns:
+    matryoshka_soa -- packed mappings of all (n*p) splines, dict with
+        knots -- x-knots followed by y-knots (padded by inf), (2*n*p)xq numpy.ndarray
+        count -- number of x-knots followed by y-knots, (2*n*p)-numpy.ndarray of ints
+        coeffs -- coefficients (padded by 0), (n*p)xr numpy.ndarray
+        stride -- number of y-coefficients, (n*p)-numpy.ndarray of ints
+        degree -- degree of the splines, int
+        shape -- number of groups and dimensions, 2-tuple (n, p)
+
+    Note: All splines are expected to be of the same degree in both axes.
+    """
+
+    _tcks = [ _tck for _matryoshka in matryoshkas for _tck in _matryoshka ]
+
+    if len({ _tck[3] for _tck in _tcks } | { _tck[4] for _tck in _tcks }) != 1:
+        raise ValueError("Matryoshka splines are expected to be of the same degree.")
+
+    _degree = int(_tcks[0][3])
+
+    _pad = lambda arrays, fill: numpy.ascontiguousarray(
+        [ numpy.pad(_a, (0, max([ len(_b) for _b in arrays ]) - len(_a)), "constant", constant_values = fill) for _a in arrays ],
+        dtype = numpy.float64
+    )
+
+    return {
+        "knots": _pad([ _tck[0] for _tck in _tcks ] + [ _tck[1] for _tck in _tcks ], numpy.inf),
+        "count": numpy.asarray([ len(_tck[0]) for _tck in _tcks ] + [ len(_tck[1]) for _tck in _tcks ], dtype = numpy.int64),
+        "coeffs": _pad([ _tck[2] for _tck in _tcks ], 0.0),
+        "stride": numpy.asarray([ len(_tck[1]) - _degree - 1 for _tck in _tcks ], dtype = numpy.int64),
+        "degree": _degree,
+        "shape": (len(matryoshkas), len(matryoshkas[0])),
+    }
+
+
+def splineBasisCompute(knots: numpy.ndarray, knots_count: numpy.ndarray, degree: int, coords: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """Compute nonzero B-spline basis functions of multiple splines.
+
+    Arguments:
+    knots -- knots of the splines (padded by inf), nxq numpy.ndarray
+    knots_count -- number of knots of the splines, n-numpy.ndarray of ints
+    degree -- degree of the splines, int
+    coords -- coordinate to evaluate each spline at, n-numpy.ndarray
+
+    Returns:
+    basis -- values of the nonzero basis functions, nx(degree+1) numpy.ndarray
+    span -- index of the knot span of the coordinates, n-numpy.ndarray of ints
+
+    Note: Coordinates outside of the spline domain are clipped, as in FITPACK.
+    """
+
+    _s = numpy.arange(len(coords))
+
+    _coords = numpy.clip(coords, knots[_s, degree], knots[_s, knots_count - degree - 1])
+
+    # knots[span] <= coords < knots[span + 1]
+    _span = numpy.clip(
+        numpy.sum(knots <= _coords[:, numpy.newaxis], axis = 1) - 1,
+        degree, knots_count - degree - 2
+    )
+
+    # Distances to the knots around the span
+    _left = _coords[:, numpy.newaxis] - knots[_s[:, numpy.newaxis], _span[:, numpy.newaxis] + 1 - numpy.arange(degree + 1)]
+    _right = knots[_s[:, numpy.newaxis], _span[:, numpy.newaxis] + numpy.arange(degree + 1)] - _coords[:, numpy.newaxis]
+
+    # Cox-de Boor recursion
+    _basis = numpy.zeros( (len(coords), degree + 1) )
+    _basis[:, 0] = 1.0
+
+    for _j in range(1, degree + 1):
+        _saved = 0.0
+
+        for _r in range(_j):
+            _temp = _basis[:, _r] / (_right[:, _r + 1] + _left[:, _j - _r])
+            _basis[:, _r] = _saved + _right[:, _r + 1] * _temp
+            _saved = _left[:, _j - _r] * _temp
+
+        _basis[:, _j] = _saved
+
+    return _basis, _span
+
+
+if NUMBA_AVAILABLE:
+    @njit(cache = True)
+    def _splinesEvaluateKernel(knots: numpy.ndarray, count: numpy.ndarray, coeffs: numpy.ndarray, stride: numpy.ndarray, degree: int, splines: numpy.ndarray, coords: numpy.ndarray) -> numpy.ndarray:
+        """Evaluate packed splines at given points, see splinesEvaluate.
+
+        Arguments:
+        knots, count, coeffs, stride, degree -- packed mappings, see matryoshkaPack
+        splines -- indices of the splines to evaluate, k-numpy.ndarray of ints
+        coords -- points in transformed coordinates, one for each spline, kx2 numpy.ndarray
+
+        Returns:
+        values -- values of the splines, k-numpy.ndarray
+        """
+        _splines = coeffs.shape[0]
+        _values = numpy.empty(len(splines))
+        _basis = numpy.empty( (2, degree + 1) )
+        _span = numpy.empty(2, dtype = numpy.int64)
+
+        for _k in range(len(splines)):
+            _s = splines[_k]
+
+            for _a in range(2):
+                _row = _s + _a * _splines
+                _n = count[_row]
+                _x = min(max(coords[_k, _a], knots[_row, degree]), knots[_row, _n - degree - 1])
+
+                # knots[span] <= x < knots[span + 1]
+                _l = degree
+                while _l < _n - degree - 2 and knots[_row, _l + 1] <= _x:
+                    _l += 1
+
+                _span[_a] = _l
+
+                # Cox-de Boor recursion
+                _basis[_a, 0] = 1.0
+
+                for _j in range(1, degree + 1):
+                    _saved = 0.0
+
+                    for _r in range(_j):
+                        _right = knots[_row, _l + _r + 1] - _x
+                        _left = _x - knots[_row, _l + _r + 1 - _j]
+                        _temp = _basis[_a, _r] / (_right + _left)
+                        _basis[_a, _r] = _saved + _right * _temp
+                        _saved = _left * _temp
+
+                    _basis[_a, _j] = _saved
+
+            _value = 0.0
+
+            for _i in range(degree + 1):
+                for _j in range(degree + 1):
+                    _value += coeffs[_s, (_span[0] - degree + _i) * stride[_s] + _span[1] - degree + _j] * _basis[0, _i] * _basis[1, _j]
+
+            _values[_k] = _value
+
+        return _values
+
+
+def splinesEvaluate(matryoshka_soa: Dict[str, numpy.ndarray], splines: numpy.ndarray, coords: numpy.ndarray) -> numpy.ndarray:
+    """Evaluate packed splines at given points.
+
+    Arguments:
+    matryoshka_soa -- packed mappings of the groups, see matryoshkaPack
+    splines -- indices of the splines to evaluate, k-numpy.ndarray of ints
+    coords -- points in transformed coordinates, one for each spline, kx2 numpy.ndarray
+
+    Returns:
+    values -- values of the splines, k-numpy.ndarray
+
+    Note: Spline of dimension 'd' of group 'g' has index 'g * p + d'.
+    """
+
+    _degree = matryoshka_soa["degree"]
+    _total = len(matryoshka_soa["coeffs"])
+
+    _splines = numpy.asarray(splines, dtype = numpy.int64)
+    _coords = numpy.ascontiguousarray(coords, dtype = numpy.float64)
+
+    if NUMBA_AVAILABLE:
+        return _splinesEvaluateKernel(
+            matryoshka_soa["knots"], matryoshka_soa["count"], matryoshka_soa["coeffs"], matryoshka_soa["stride"],
+            _degree, _splines, _coords
+        )
+
+    # Basis functions of all x-knots and y-knots at once
+    _rows = numpy.concatenate((_splines, _splines + _total))
+
+    _basis, _span = splineBasisCompute(
+        matryoshka_soa["knots"][_rows], matryoshka_soa["count"][_rows], _degree,
+        _coords.T.reshape(-1)
+    )
+
+    _k = len(_splines)
+    _stride = matryoshka_soa["stride"][_splines]
+
+    # Coefficients are stored row-wise; c[ix * stride + iy]
+    _index = (
+        ((_span[:_k] - _degree) * _stride + _span[_k:] - _degree)[:, numpy.newaxis, numpy.newaxis]
+        + numpy.arange(_degree + 1)[numpy.newaxis, :, numpy.newaxis] * _stride[:, numpy.newaxis, numpy.newaxis]
+        + numpy.arange(_degree + 1)[numpy.newaxis, numpy.newaxis, :]
+    )
+
+    return numpy.einsum(
+        "sij,si,sj->s",
+        matryoshka_soa["coeffs"][_splines[:, numpy.newaxis, numpy.newaxis], _index],
+        _basis[:_k], _basis[_k:]
+    )
+
+
+def matryoshkaMapBatch(matryoshka_soa: Dict[str, numpy.ndarray], coords: numpy.ndarray) -> numpy.ndarray:
+    """Transform points through Matryoshka mappings of their groups.
+
+    Arguments:
+    matryoshka_soa -- packed mappings of the groups, see matryoshkaPack
+    coords -- points in transformed coordinates to convert, one for each group, nx2 numpy.ndarray
+
+    Returns:
+    rcoords -- points in real coordinates, nxp numpy.ndarray
+
+    Note: This is equivalent to 'matryoshkaMap' called for each group,
+    but all splines are evaluated at once.
+    """
+
+    _groups, _dims = matryoshka_soa["shape"]
+
+    return splinesEvaluate(
+        matryoshka_soa,
+        numpy.arange(_groups * _dims),
+        numpy.repeat(coords, _dims, axis = 0)
+    ).reshape(_groups, _dims)
+
+
+def matryoshkaMapBatchAll(matryoshka_soa: Dict[str, numpy.ndarray], coords: numpy.ndarray) -> numpy.ndarray:
+    """Transform points through Matryoshka mappings of all groups.
+
+    Arguments:
+    matryoshka_soa -- packed mappings of the groups, see matryoshkaPack
+    coords -- points in transformed coordinates to convert, mx2 numpy.ndarray
+
+    Returns:
+    rcoords -- points in real coordinates for each group, nxmxp numpy.ndarray
+
+    Note: This is equivalent to 'matryoshkaMap' called for each group
+    with the same points.
+    """
+
+    _groups, _dims = matryoshka_soa["shape"]
+    _coords = numpy.asarray(coords, dtype = numpy.float64)
+
+    return splinesEvaluate(
+        matryoshka_soa,
+        numpy.repeat(numpy.arange(_groups * _dims), len(_coords)),
+        numpy.tile(_coords, (_groups * _dims, 1))
+    ).reshape(_groups, _dims, len(_coords)).transpose(0, 2, 1)
@@ -8,11 +8,30 @@
 
 import numpy
 
+# Nearest neighbour search
+from scipy.spatial import cKDTree
+
+from typing import Dict, Tuple
+
 from ng_trajectory.segmentators.utils import gridCompute
 
+from ng_trajectory import NUMBA_AVAILABLE
+
+if NUMBA_AVAILABLE:
+    from numba import njit
+
 
 # Global variables
 INVALID_POINTS = []
+VALID_POINTS = None
+VALID_TREE = None
+VALID_OCCUPANCY = None
+K_MAX = 1.5
+
+# Size of the broadcasted arrays [B]; should fit into L2 cache
+BLOCK_BYTES = 2 ** 20
+# Number of valid points compared at once
+BLOCK_VALID = 4096
 
 
 # Parameters
@@ -21,16 +40,148 @@ P = ParameterList()
 P.createAdd("k_max", 1.5, float, "Maximum allowed curvature in abs [m^-1]", "")
 
 
+######################
+# Utilities
+######################
+
+def gridSplit(grid: any) -> Tuple[float, float]:
+    """Split the grid into its x-size and y-size.
+
+    Arguments:
+    grid -- size of the grid, float or 2-list of floats
+
+    Returns:
+    grid_xy -- x-size and y-size of the grid, 2-tuple (float, float)
+    """
+    _grid = numpy.broadcast_to(numpy.asarray(grid, dtype = numpy.float64), (2, ))
+
+    return float(_grid[0]), float(_grid[1])
+
+
+def occupancyCreate(points: numpy.ndarray, grid: float) -> Dict[str, any]:
+    """Create a bit-packed occupancy grid of points.
+
+    Arguments:
+    points -- points aligned to a square grid, nx(>=2) numpy.ndarray
+    grid -- size of the grid, float
+
+    Returns:
+    occupancy -- occupancy grid, None when the points are not aligned to the grid, dict with
+        bitmap -- bit-packed occupied cells (rows are y, columns x), hxw numpy.ndarray of uint8
+        origin -- real coordinates of the cell [0, 0], 2-numpy.ndarray
+        grid -- size of the grid, float
+
+    Note: The grid has one free cell on each side, so that all points
+    outside of it can be clipped onto its border.
+    """
+    _origin = numpy.min(points[:, :2], axis = 0) - grid
+    _cells = numpy.round((points[:, :2] - _origin) / grid).astype(numpy.int64)
+
+    if not numpy.allclose(_cells * grid + _origin, points[:, :2], rtol = 0, atol = grid * 1e-6):
+        return None
+
+    _occupied = numpy.zeros(numpy.max(_cells, axis = 0)[::-1] + 2, dtype = bool)
+    _occupied[_cells[:, 1], _cells[:, 0]] = True
+
+    return {
+        "bitmap": numpy.packbits(_occupied, axis = 1),
+        "origin": _origin,
+        "grid": grid,
+    }
+
+
+def occupancyCheck(occupancy: Dict[str, any], points: numpy.ndarray) -> numpy.ndarray:
+    """Check whether there is an occupied cell near the points.
+
+    Arguments:
+    occupancy -- occupancy grid, see occupancyCreate
+    points -- points to be checked, nx(>=2) numpy.ndarray
+
+    Returns:
+    valid_mask -- mask of points closer than grid (in each axis) to an occupied cell, n-numpy.ndarray of bools
+
+    Note: Only the cells of the floor and ceil of the cell coordinates are
+    closer than the grid size, so at most four cells are checked.
+    """
+    _bitmap = occupancy["bitmap"]
+    _shape = (_bitmap.shape[1] * 8 - 1, _bitmap.shape[0] - 1)
+
+    # Non-finite points are invalid (and cannot be converted to cells)
+    _finite = numpy.isfinite(points[:, :2]).all(axis = 1)
+
+    _coords = (points[_finite, :2] - occupancy["origin"]) / occupancy["grid"]
+
+    # Points outside the grid fall onto its free border
+    _low = numpy.clip(numpy.floor(_coords), 0, _shape).astype(numpy.int64)
+    _high = numpy.clip(numpy.ceil(_coords), 0, _shape).astype(numpy.int64)
+
+    _valid = numpy.zeros(len(_coords), dtype = bool)
+
+    for _x in (_low[:, 0], _high[:, 0]):
+        for _y in (_low[:, 1], _high[:, 1]):
+            _valid |= ((_bitmap[_y, _x >> 3] >> (7 - (_x & 7))) & 1).astype(bool)
+
+    _valid_mask = numpy.zeros(len(points), dtype = bool)
+    _valid_mask[_finite] = _valid
+
+    return _valid_mask
+
+
+if NUMBA_AVAILABLE:
+    @njit(cache = True)
+    def _penalizeKernel(points_xy: numpy.ndarray, valid_points: numpy.ndarray, grid_x: float, grid_y: float) -> Tuple[numpy.ndarray, int]:
+        """Find points that do not have a valid point in their neighbourhood.
+
+        Arguments:
+        points_xy -- points to be checked, nx2 numpy.ndarray
+        valid_points -- valid area of the track, mx2 numpy.ndarray
+        grid_x -- x-size of the grid, float
+        grid_y -- y-size of the grid, float
+
+        Returns:
+        invalid_mask -- mask of the invalid points, n-numpy.ndarray of bools
+        invalid -- number of the invalid points, int
+
+        Note: The scan over the valid points is stopped as soon as
+        a nearby valid point is found. The kernel is not parallel, as it
+        is already run by multiple workers of the optimizer.
+        """
+        invalid_mask = numpy.ones(points_xy.shape[0], dtype = numpy.bool_)
+
+        for _i in range(points_xy.shape[0]):
+            for _v in range(valid_points.shape[0]):
+                if abs(valid_points[_v, 0] - points_xy[_i, 0]) < grid_x and abs(valid_points[_v, 1] - points_xy[_i, 1]) < grid_y:
+                    invalid_mask[_i] = False
+                    break
+
+        return invalid_mask, invalid_mask.sum()
+
+
 ######################
 # Functions
 ######################
 
-def init(**kwargs) -> None:
-    """Initialize penalizer."""
+def init(valid_points: numpy.ndarray = None, **kwargs) -> None:
+    """Initialize penalizer.
+
+    Arguments:
+    valid_points -- valid area of the track, mx2 numpy.ndarray, default None
+    **kwargs -- arguments not caught by previous parts
+    """
+    global VALID_POINTS, VALID_TREE, VALID_OCCUPANCY, K_MAX
 
     # Update parameters
     P.updateAll(kwargs)
 
+    K_MAX = P.getValue("k_max")
+
+    # Build a tree of the valid points for nearest neighbour queries
+    # and their occupancy grid (for the default grid size)
+    if valid_points is not None:
+        VALID_POINTS = valid_points
+        VALID_TREE = cKDTree(valid_points[:, :2])
+        VALID_OCCUPANCY = occupancyCreate(valid_points, gridCompute(valid_points))
+
 
 def penalize(points: numpy.ndarray, valid_points: numpy.ndarray, grid: float, penalty: float = 100, **overflown) -> float:
     """Get a penalty for the candidate solution based on number of incorrectly placed points and path curvature.
@@ -45,38 +196,84 @@ def penalize(points: numpy.ndarray, valid_points: numpy.ndarray, grid: float, pe
     Returns:
     rpenalty -- value of the penalty, 0 means no penalty, float
     """
-    global INVALID_POINTS
-
-    # Update parameters
-    P.updateAll(overflown, reset = False)
-
-    _k_max = P.getValue("k_max")
+    global INVALID_POINTS, VALID_POINTS, VALID_TREE, VALID_OCCUPANCY, K_MAX
 
+    # Parameters are updated in 'init()'; 'k_max' may still be overridden by the call
+    _k_max = overflown["k_max"] if "k_max" in overflown else K_MAX
 
     # Use the grid or compute it
     _grid = grid if grid else gridCompute(points)
 
-    invalid = 0
+    _grid_x, _grid_y = gridSplit(_grid)
+
     INVALID_POINTS.clear()
 
-    for _p in points:
-        if not numpy.any(numpy.all(numpy.abs( numpy.subtract(valid_points, _p[:2]) ) < _grid, axis = 1)):
-            INVALID_POINTS.append(_p)
-            invalid += 1
+    # The occupancy grid and the tree are used only for the valid points they were built from.
+    # The occupancy grid matches the check only for its own grid size.
+    if VALID_OCCUPANCY is not None and valid_points is VALID_POINTS and _grid_x == _grid_y == VALID_OCCUPANCY["grid"]:
+        _invalid_mask = ~occupancyCheck(VALID_OCCUPANCY, points)
+        invalid = int(numpy.sum(_invalid_mask))
+
+    # Chebyshev distance of the tree matches the check only on a square grid.
+    elif VALID_TREE is not None and valid_points is VALID_POINTS and _grid_x == _grid_y:
+        # Non-finite points are invalid (and cannot be queried)
+        _finite = numpy.isfinite(points[:, :2]).all(axis = 1)
+
+        _dists, _ = VALID_TREE.query(points[_finite, :2], k = 1, p = numpy.inf, distance_upper_bound = _grid_x)
+
+        _invalid_mask = numpy.ones(len(points), dtype = bool)
+        _invalid_mask[_finite] = _dists >= _grid_x
+        invalid = int(numpy.sum(_invalid_mask))
+
+    elif NUMBA_AVAILABLE:
+        _invalid_mask, invalid = _penalizeKernel(
+            numpy.ascontiguousarray(points[:, :2], dtype = numpy.float64),
+            numpy.ascontiguousarray(valid_points[:, :2], dtype = numpy.float64),
+            _grid_x, _grid_y
+        )
+
+    else:
+        _valid_mask = numpy.zeros(len(points), dtype = bool)
+
+        # Compare the points in tiles (block of candidate points x BLOCK_VALID valid points)
+        # so that the broadcasted array (block x BLOCK_VALID float64) stays in the cache
+        _block = max(1, BLOCK_BYTES // (8 * BLOCK_VALID))
+
+        for _v in range(0, len(valid_points), BLOCK_VALID):
+            # Only points without a nearby valid point have to be checked
+            _pending = numpy.flatnonzero(~_valid_mask)
+
+            if len(_pending) == 0:
+                break
+
+            _valid_block = valid_points[_v:_v + BLOCK_VALID, :2]
+
+            for _b in range(0, len(_pending), _block):
+                _pending_block = _pending[_b:_b + _block]
+
+                # Check x-coordinates first; y-coordinates are checked only for the pairs close in x
+                _pi, _vi = numpy.nonzero(
+                    numpy.abs(
+                        numpy.subtract(_valid_block[numpy.newaxis, :, 0], points[_pending_block, numpy.newaxis, 0])
+                    ) < _grid_x
+                )
+
+                _near = numpy.abs(numpy.subtract(_valid_block[_vi, 1], points[_pending_block[_pi], 1])) < _grid_y
+
+                _valid_mask[_pending_block[_pi[_near]]] = True
+
+        _invalid_mask = ~_valid_mask
+        invalid = int(numpy.sum(_invalid_mask))
 
     if invalid == 0:
-        invalid = numpy.add(
-            numpy.sum(
-                points[points[:, 2] > _k_max, 2]
-            ),
-            -numpy.sum(
-                points[points[:, 2] < -_k_max, 2]
-            )
-        ) / 100
-
-        INVALID_POINTS += points[(points[:, 2] > _k_max) | (points[:, 2] < -_k_max), :].tolist()
-        print (points[(points[:, 2] > _k_max) | (points[:, 2] < -_k_max), 2])
-
-    print(points[(points[:, 2] > _k_max) | (points[:, 2] < -_k_max), 2])
+        _k = numpy.abs(points[:, 2])
+        _invalid_mask = _k > _k_max
+
+        invalid = numpy.sum(_k[_invalid_mask]) / 100
+
+    # Invalid points are stored only outside of the optimization,
+    # as during it they are computed (and discarded) by the workers.
+    if not overflown.get("optimization", True):
+        INVALID_POINTS.extend(points[_invalid_mask])
 
     return invalid * penalty * 10
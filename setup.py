@@ -67,7 +67,8 @@ setup(
     install_requires=['nevergrad==0.3.0', "scipy>=0.18.0", "numpy>=1.12.0", "Pillow>=4.2.0", "tqdm"],
     python_requires='>=3.6',
     extras_require={
-        "plot_support": "matplotlib"
+        "plot_support": "matplotlib",
+        "jit_support": "numba",
     },
     scripts=['bin/ng_run', 'bin/ng_generate_data', 'bin/ng_help', 'bin/ng_curvature_gui', 'bin/ng_graph', 'bin/ng_plot'],
 )